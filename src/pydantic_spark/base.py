@@ -1,192 +1,399 @@
-from typing import List, Tuple
 from collections import defaultdict
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional, Set, Tuple, Union, cast
+from uuid import UUID
 
 from pydantic import BaseModel
+from pydantic.fields import SHAPE_SINGLETON
+from pydantic.utils import ROOT_KEY
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, without it definitions are not shared between schemas
+    orjson = None  # type: ignore[assignment]
+
+# A spark type is either the name of a primitive type or the json representation of a complex type
+SparkType = Union[str, Dict[str, Any]]
+
+# Spark type and logicalType for the primitive json schema types, keyed on (type, format)
+# A format that is not listed falls back to the (type, None) entry
+_PRIMITIVE_TYPES: Dict[Tuple[Optional[str], Optional[str]], Tuple[str, Optional[str]]] = {
+    ("string", None): ("string", None),
+    ("string", "date-time"): ("timestamp", None),
+    ("string", "date"): ("date", None),
+    # ("string", "time"): ...  # FIXME: time type in spark does not exist
+    ("string", "uuid"): ("string", "uuid"),
+    ("number", None): ("double", None),
+    # integer in python can be a long
+    ("integer", None): ("long", None),
+    ("boolean", None): ("boolean", None),
+    # Unions of primitives that are not handled by get_fields
+    ("list", None): ("string", None),
+}
+
+# Spark type and logicalType for the python types of pydantic fields, see SparkBase._spark_schema_from_fields
+_PYTHON_TYPES: Dict[type, Tuple[str, Optional[str]]] = {
+    str: ("string", None),
+    int: ("long", None),
+    float: ("double", None),
+    bool: ("boolean", None),
+    datetime: ("timestamp", None),
+    date: ("date", None),
+    UUID: ("string", "uuid"),
+}
+
+# Types of default values that pydantic writes to the json schema as they are
+_PLAIN_DEFAULTS = (str, int, float, bool)
+
+# Returned by _get_type for fields without any metadata, it is shared and must never be mutated
+_EMPTY_META: Dict[str, Any] = {}
+
+# Prefix of the refs pydantic generates for its definitions
+_DEFINITIONS_PREFIX = "#/definitions/"
+_DEFINITIONS_PREFIX_LEN = len(_DEFINITIONS_PREFIX)
+
+# Types of self-contained definitions, keyed on their json, shared by all schemas
+# The cache is never cleared, it holds one entry for every distinct definition seen by the process
+_DEFINITION_CACHE: Dict[bytes, SparkType] = {}
+
+
+class _Ctx:
+    """State shared by the functions that convert a single pydantic schema"""
+
+    __slots__ = ("definitions", "classes_seen", "in_progress")
+
+    def __init__(self, schema: Dict[str, Any]):
+        self.definitions: Dict[str, Dict[str, Any]] = schema.get("definitions") or {}
+        # Fully resolved types, keyed on ref
+        self.classes_seen: Dict[str, SparkType] = {}
+        # Refs that are currently being resolved
+        self.in_progress: Set[str] = set()
+
+
+def _get_definition(ref: str, ctx: _Ctx) -> Dict[str, Any]:
+    id = ref[_DEFINITIONS_PREFIX_LEN:] if ref.startswith(_DEFINITIONS_PREFIX) else ref
+    d = ctx.definitions.get(id)
+    if d is None:
+        raise RuntimeError(f"Definition {id} does not exist")
+    return d
+
+
+def _get_type_of_definition(ref: str, ctx: _Ctx) -> SparkType:
+    """Returns the type of a definition, every ref is only resolved once"""
+    spark_type = ctx.classes_seen.get(ref)
+    if spark_type is not None:
+        return spark_type
+
+    in_progress = ctx.in_progress
+    if ref in in_progress:
+        # If this ref is still in the process of being resolved further up, this must mean
+        #  that we have a recursive type definition and should abort the recursion with some generic type
+        return {
+            "type": {
+                "type": "map",
+                "keyType": "string",
+                "valueType": "string",
+                "valueContainsNull": True,
+            }
+        }
+
+    in_progress.add(ref)
+    spark_type = _resolve_definition(ref, ctx)
+    in_progress.discard(ref)
+    ctx.classes_seen[ref] = spark_type
+    return spark_type
+
+
+def _resolve_definition(ref: str, ctx: _Ctx) -> SparkType:
+    """Reading definition of base schema for nested structs"""
+    d = _get_definition(ref, ctx)
+
+    if orjson is None:
+        return _definition_to_spark(d, ctx)
+
+    # A definition without refs converts to the same type in every schema, so it is shared between schemas.
+    #  The keys are not sorted: struct fields are positional, so the order of the properties is part of the key
+    try:
+        key = orjson.dumps(d)
+    except orjson.JSONEncodeError:
+        return _definition_to_spark(d, ctx)
+    if b'"$ref"' in key:
+        return _definition_to_spark(d, ctx)
+
+    spark_type = _DEFINITION_CACHE.get(key)
+    if spark_type is None:
+        spark_type = _DEFINITION_CACHE[key] = _definition_to_spark(d, ctx)
+    return spark_type
+
+
+def _definition_to_spark(d: Dict[str, Any], ctx: _Ctx) -> SparkType:
+    if "enum" in d:
+        enum_type = d.get("type")
+        if enum_type == "string":
+            return "string"
+        elif enum_type == "number":
+            return "double"
+        elif enum_type == "integer":
+            return "long"
+        else:
+            raise RuntimeError(f"Unknown enum type: {enum_type}")
+    else:
+        fields = _get_flat_fields(d)
+        if fields is None:
+            fields = _get_fields(d, ctx)
+        return {
+            "type": "struct",
+            "fields": fields,
+        }
+
+
+def _get_primitive(t: Optional[str], f: Optional[str]) -> Optional[Tuple[str, Optional[str]]]:
+    """Returns the spark type and logicalType of a primitive json schema type, None for any other type"""
+    primitive = _PRIMITIVE_TYPES.get((t, f))
+    if primitive is None and f is not None:
+        primitive = _PRIMITIVE_TYPES.get((t, None))
+    return primitive
+
+
+def _struct_field(name: str, spark_type: SparkType, metadata: Dict[str, Any], required: bool) -> Dict[str, Any]:
+    """Returns a field of a struct, the metadata must already contain the parentClass"""
+    return {
+        "name": name,
+        "nullable": "default" not in metadata and not required,
+        "metadata": metadata,
+        "type": spark_type,
+    }
+
+
+def _get_type(value: Dict[str, Any], ctx: _Ctx) -> Tuple[SparkType, Dict[str, Any]]:
+    """Returns a type of single field"""
+    # Nested models are referenced with nothing but a $ref
+    if len(value) == 1 and "$ref" in value:
+        return _get_type_of_definition(value["$ref"], ctx), _EMPTY_META
+
+    v_get = value.get
+    t = v_get("type")
+    if not t:
+        t = "list" if v_get("anyOf") else None
+    f = v_get("format")
+    r = v_get("$ref")
+    metadata = {"default": value["default"]} if "default" in value else _EMPTY_META
+    if r is not None:
+        return _get_type_of_definition(r, ctx), metadata
+
+    spark_type: SparkType
+    primitive = _get_primitive(t, f)
+    if primitive is not None:
+        spark_type, logical_type = primitive
+        if logical_type is not None:
+            if metadata is _EMPTY_META:
+                metadata = {"logicalType": logical_type}
+            else:
+                metadata["logicalType"] = logical_type
+    elif t == "array":
+        tn, metadata = _get_type(value["items"], ctx)
+        spark_type = {
+            "type": "array",
+            "elementType": tn,
+            "containsNull": True,
+        }
+    elif t == "object":
+        a = v_get("additionalProperties")
+        value_type: SparkType
+        if a is None:
+            value_type = "string"
+        else:
+            value_type, m = _get_type(a, ctx)
+        # if isinstance(value_type, dict) and len(value_type) == 1:
+        # value_type = value_type.get("type")
+        spark_type = {"keyType": "string", "type": "map", "valueContainsNull": True, "valueType": value_type}
+    else:
+        raise NotImplementedError(
+            f"Type '{t}' not support yet, "
+            f"please report this at https://github.com/godatadriven/pydantic-avro/issues"
+        )
+    return spark_type, metadata
+
+
+def _copy_schema(value: Any) -> Any:
+    """Copy the dicts and lists of a spark schema
+
+    Unlike copy.deepcopy, a type that is referenced from several places, like a resolved definition, ends up as
+    separate objects in the copy.
+    """
+    if isinstance(value, dict):
+        return {k: _copy_schema(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_copy_schema(v) for v in value]
+    return value
+
+
+def _get_flat_fields(s: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    """Return the fields of a struct that only has primitive fields, None for any other struct"""
+    properties = s.get("properties") or {}
+    primitives = []
+    for value in properties.values():
+        t = value.get("type")
+        primitive = _get_primitive(t, value.get("format"))
+        # A missing type also means a union or a ref
+        if primitive is None or t is None:
+            return None
+        primitives.append(primitive)
+
+    required = frozenset(s.get("required", ()))
+    p_class = s.get("title")
+    fields = []
+    for (key, value), (spark_type, logical_type) in zip(properties.items(), primitives):
+        metadata = {"default": value["default"]} if "default" in value else {}
+        if logical_type is not None:
+            metadata["logicalType"] = logical_type
+        metadata["parentClass"] = p_class
+        fields.append(_struct_field(key, spark_type, metadata, key in required))
+    return fields
+
+
+def _get_fields(s: Dict[str, Any], ctx: _Ctx) -> List[Dict[str, Any]]:
+    """Return a list of fields of a struct"""
+    fields: List[Dict[str, Any]] = []
+
+    required = frozenset(s.get("required", ()))
+    p_class = s.get("title")
+    properties = s.get("properties") or {}
+    spark_type: SparkType
+    for key, value in properties.items():
+        # This means we have a Union type.
+        if anyof := value.get("anyOf"):
+            first_value = anyof[0]
+            first_subtype, first_metadata = _get_type(first_value, ctx)
+
+            # For a union of structs, compute the schema for the various sub-types and merge their
+            #  fields together
+            if first_subtype == "struct":
+                subtype_fields = defaultdict(list)
+                for v in anyof:
+                    spark_type, metadata = _get_type(v, ctx)
+                    struct_type = cast(Dict[str, Any], spark_type)
+                    # Coalesce subfields with the same name into 1 collection...
+                    for field in struct_type["fields"]:
+                        subtype_fields[field["name"]].append(field)
+
+                unique = []
+                for name, subfields in subtype_fields.items():
+                    first_field = subfields[0]
+                    if len(subfields) == len(anyof):
+                        nullable = all(field["nullable"] for field in subfields)
+                        first_field["nullable"] = nullable
+                    else:
+                        # This means that this field wasn't encountered in all of our sub-models, and therefore
+                        #  must be nullable in our final union'd type
+                        first_field["nullable"] = True
+
+                    first_field["metadata"]["parentClass"] = p_class
+                    unique.append(first_field)
+
+                struct_type["fields"] = unique
+
+            else:
+                # For the time being, for unions of e.g. Primitives, just take the first type
+                spark_type, metadata = first_subtype, first_metadata
+
+        else:
+            spark_type, metadata = _get_type(value, ctx)
+
+        metadata = {**metadata, "parentClass": p_class} if metadata else {"parentClass": p_class}
+        fields.append(_struct_field(key, spark_type, metadata, key in required))
+    return fields
 
 
 class SparkBase(BaseModel):
     """This is base pydantic class that will add some methods"""
 
     @classmethod
-    def spark_schema(cls) -> dict:
-        """Return the avro schema for the pydantic class"""
-        schema = cls.schema()
-        return cls._spark_schema(schema)
+    def spark_schema(cls) -> Dict[str, Any]:
+        """Return the spark schema for the pydantic class
 
-    @staticmethod
-    def _spark_schema(schema: dict) -> dict:
-        """Return the spark schema for the given pydantic schema"""
-        classes_seen = {}
-
-        def get_definition(ref: str, schema: dict):
-            id = ref.replace("#/definitions/", "")
-            d = schema.get("definitions", {}).get(id)
-            if d is None:
-                raise RuntimeError(f"Definition {id} does not exist")
-            return d
-
-        def get_type_of_definition(ref: str, schema: dict):
-            """Reading definition of base schema for nested structs"""
-            d = get_definition(ref, schema)
-
-            if "enum" in d:
-                enum_type = d.get("type")
-                if enum_type == "string":
-                    return "string"
-                elif enum_type == "number":
-                    return "double"
-                elif enum_type == "integer":
-                    return "long"
-                else:
-                    raise RuntimeError(f"Unknown enum type: {enum_type}")
-            else:
-                return {
-                    "type": "struct",
-                    "fields": get_fields(d),
-                }
-
-        def get_type(value: dict) -> Tuple[str, dict]:
-            """Returns a type of single field"""
-            t = value.get("type")
-            if not t:
-                t = 'list' if value.get('anyOf') else None
-            f = value.get("format")
-            r = value.get("$ref")
-            a = value.get("additionalProperties")
-            metadata = {}
-            if "default" in value:
-                metadata["default"] = value.get("default")
-            if r is not None:
-                class_name = r.replace("#/definitions/", "")
-                match classes_seen.get(class_name):
-                    case None:
-                        # Make a record of the fact that we HAVE seen this class name,
-                        #  but have not yet fully resolved its type
-                        classes_seen[class_name] = "in progress"
-                        spark_type = get_type_of_definition(r, schema)
-                        classes_seen[class_name] = spark_type
-
-                    case "in progress":
-                        # If we have seen this class name, but are still in the process of fully
-                        #  resolving its type, this must mean that we have a recursive type
-                        #  definition and should abort the recursion with some generic type
-                        spark_type = {
-                            "type": {
-                                "type": "map",
-                                "keyType": "string",
-                                "valueType": "string",
-                                "valueContainsNull": True,
-                            }
-                        }
-                        classes_seen[class_name] = spark_type
-
-                    case _:
-                        spark_type = classes_seen[class_name]
-
-            elif t == "array":
-                items = value.get("items")
-                tn, metadata = get_type(items)
-                spark_type = {
-                    "type": "array",
-                    "elementType": tn,
-                    "containsNull": True,
-                }
-            elif t == "string" and f == "date-time":
-                spark_type = "timestamp"
-            elif t == "string" and f == "date":
-                spark_type = "date"
-            # elif t == "string" and f == "time":  # FIXME: time type in spark does not exist
-            #     spark_type = {
-            #         "type": "long",
-            #         "logicalType": "time-micros",
-            #     }
-            elif t == "string" and f == "uuid":
-                spark_type = "string"
-                metadata["logicalType"] = "uuid"
-            elif t == "string":
-                spark_type = "string"
-            elif t == "number":
-                spark_type = "double"
-            elif t == "integer":
-                # integer in python can be a long
-                spark_type = "long"
-            elif t == "boolean":
-                spark_type = "boolean"
-            elif t == 'list':
-                spark_type = "string"
-            elif t == "object":
-                if a is None:
-                    value_type = "string"
-                else:
-                    value_type, m = get_type(a)
-                # if isinstance(value_type, dict) and len(value_type) == 1:
-                # value_type = value_type.get("type")
-                spark_type = {"keyType": "string", "type": "map", "valueContainsNull": True, "valueType": value_type}
+        The schema is computed once per class and cached on the class itself. Callers receive a copy made of plain
+        dicts and lists that shares nothing with the cache or with other results, so it can be mutated, pickled and
+        used from multiple threads.
+        """
+        # Look in the class namespace directly so subclasses never pick up the cache of a parent
+        cached = cls.__dict__.get("__spark_schema__")
+        if cached is None:
+            cached = cls._spark_schema_from_fields()
+            if cached is None:
+                cached = cls._spark_schema(cls.schema())
+            type.__setattr__(cls, "__spark_schema__", cached)
+        return _copy_schema(cached)
+
+    @classmethod
+    def _spark_schema_from_fields(cls, parents: Tuple[type, ...] = ()) -> Optional[Dict[str, Any]]:
+        """Return the spark schema built directly from the pydantic fields, without generating the json schema first
+
+        Returns None when the class has a field this does not support, the json schema has to be used for those.
+        The outcome is cached per class.
+        """
+        cached = cls.__dict__.get("__spark_schema_from_fields__")
+        if cached is not None:
+            return cached or None
+
+        result = cls._fields_to_spark(parents + (cls,))
+        # False marks a class that is not supported, that does not depend on the parents
+        type.__setattr__(cls, "__spark_schema_from_fields__", result or False)
+        return result
+
+    @classmethod
+    def _fields_to_spark(cls, parents: Tuple[type, ...]) -> Optional[Dict[str, Any]]:
+        config = cls.__config__
+        if config.schema_extra or ROOT_KEY in cls.__fields__:
+            return None
+        # A class that overrides schema() must get the schema it generates
+        if getattr(cls.schema, "__func__", None) is not BaseModel.schema.__func__:  # type: ignore[attr-defined]
+            return None
+        p_class = config.title or cls.__name__
+
+        fields = []
+        for field in cls.__fields__.values():
+            field_info = field.field_info
+            if field.shape != SHAPE_SINGLETON or field.sub_fields or field_info.const or field_info.extra:
+                return None
+
+            metadata: Dict[str, Any] = {}
+            default = field.default
+            if not field.required and default is not None:
+                if type(default) not in _PLAIN_DEFAULTS:
+                    return None
+                metadata["default"] = default
+
+            field_type = field.type_
+            primitive = _PYTHON_TYPES.get(field_type)
+            if primitive is not None:
+                spark_type: SparkType
+                spark_type, logical_type = primitive
+                if logical_type is not None:
+                    metadata["logicalType"] = logical_type
+            elif isinstance(field_type, type) and issubclass(field_type, SparkBase):
+                # Nested models with a title, description or default are not plain refs in the json schema,
+                #  and nested models that refer back to one of their parents are recursive
+                if metadata or field_info.title or field_info.description or field_type in parents:
+                    return None
+                nested = field_type._spark_schema_from_fields(parents)
+                if nested is None:
+                    return None
+                spark_type = {"type": "struct", "fields": nested["fields"]}
             else:
-                raise NotImplementedError(
-                    f"Type '{t}' not support yet, "
-                    f"please report this at https://github.com/godatadriven/pydantic-avro/issues"
-                )
-            return spark_type, metadata
-
-        def get_fields(s: dict) -> List[dict]:
-            """Return a list of fields of a struct"""
-            fields = []
-
-            required = s.get("required", [])
-            for key, value in s.get("properties", {}).items():
-                p_class = s.get("title")
-
-                # This means we have a Union type.
-                if anyof := value.get('anyOf'):
-                    first_value = anyof[0]
-                    first_subtype, first_metadata = get_type(first_value)
-
-                    match first_subtype:
-                        # For a union of structs, compute the schema for the various sub-types and merge their
-                        #  fields together
-                        case "struct":
-                            subtype_fields = defaultdict(lambda: [])
-                            for v in anyof:
-                                spark_type, metadata = get_type(v)
-                                spark_type_fields = spark_type.get("fields")
-                                # Coalesce subfields with the same name into 1 collection...
-                                for field in spark_type_fields:
-                                    subtype_fields[field["name"]].append(field)
-
-                            unique = []
-                            for name, subfields in subtype_fields.items():
-                                first_field = subfields[0]
-                                if len(subfields) == len(anyof):
-                                    nullable = all(field["nullable"] for field in subfields)
-                                    first_field["nullable"] = nullable
-                                else:
-                                    # This means that this field wasn't encountered in all of our sub-models, and therefore
-                                    #  must be nullable in our final union'd type
-                                    first_field["nullable"] = True
-
-                                first_field["metadata"]["parentClass"] = p_class
-                                unique.append(first_field)
-
-                            spark_type["fields"] = unique
-
-                        # For the time being, for unions of e.g. Primitives, just take the first type
-                        case _:
-                            spark_type, metadata = first_subtype, first_metadata
-
-                else:
-                    spark_type, metadata = get_type(value)
-
-                metadata["parentClass"] = p_class
-                struct_field = {
-                    "name": key,
-                    "nullable": "default" not in metadata and key not in required,
-                    "metadata": metadata,
-                    "type": spark_type,
-                }
-                fields.append(struct_field)
-            return fields
-
-        fields = get_fields(schema)
+                return None
+
+            metadata["parentClass"] = p_class
+            fields.append(_struct_field(field.alias, spark_type, metadata, bool(field.required)))
 
         return {"fields": fields, "type": "struct"}
+
+    @staticmethod
+    def _spark_schema(schema: Dict[str, Any]) -> Dict[str, Any]:
+        """Return the spark schema for the given pydantic schema, it shares nothing with the caches"""
+        # Most models only have primitive fields, those don't need any of the state to resolve refs
+        fields = _get_flat_fields(schema)
+        if fields is None:
+            fields = _get_fields(schema, _Ctx(schema))
+
+        return {"fields": _copy_schema(fields), "type": "struct"}
@@ -1,9 +1,11 @@
 import json
+import pickle
 from datetime import date, datetime
 from enum import Enum
 from typing import Dict, List, Optional
 from uuid import UUID
 
+import pytest
 from pyspark.sql.types import (
     ArrayType,
     BooleanType,
@@ -17,6 +19,7 @@ from pyspark.sql.types import (
     TimestampType,
 )
 
+from pydantic_spark import base
 from pydantic_spark.base import SparkBase
 
 
@@ -283,3 +286,157 @@ def test_enum():
     )
     result = TestEnum.spark_schema()
     assert result == json.loads(expected_schema.json())
+
+
+class InheritedModel(Nested2Model):
+    c112: int
+
+
+def test_schema_cache():
+    result = Nested2Model.spark_schema()
+    result["fields"].clear()
+    assert Nested2Model.spark_schema() == json.loads(
+        StructType([StructField("c111", StringType(), nullable=False, metadata={"parentClass": "Nested2Model"})]).json()
+    )
+
+    # A subclass must not inherit the cached schema of its parent
+    result = InheritedModel.spark_schema()
+    assert [f["name"] for f in result["fields"]] == ["c111", "c112"]
+
+
+class RecursiveModel(SparkBase):
+    c1: str
+    c2: Optional["RecursiveModel"]
+
+
+RecursiveModel.update_forward_refs()
+
+
+class RecursiveParent(SparkBase):
+    c1: RecursiveModel
+
+
+def test_recursive():
+    fallback = {
+        "type": {"type": "map", "keyType": "string", "valueType": "string", "valueContainsNull": True},
+    }
+    result = RecursiveParent.spark_schema()
+    assert result == {
+        "fields": [
+            {
+                "name": "c1",
+                "nullable": False,
+                "metadata": {"parentClass": "RecursiveParent"},
+                "type": {
+                    "type": "struct",
+                    "fields": [
+                        {
+                            "name": "c1",
+                            "nullable": False,
+                            "metadata": {"parentClass": "RecursiveModel"},
+                            "type": "string",
+                        },
+                        {
+                            "name": "c2",
+                            "nullable": True,
+                            "metadata": {"parentClass": "RecursiveModel"},
+                            "type": fallback,
+                        },
+                    ],
+                },
+            }
+        ],
+        "type": "struct",
+    }
+
+
+class FieldsModel(SparkBase):
+    c1: str
+    c2: Optional[UUID]
+    c3: int = 1
+    c4: Nested2Model
+
+
+def test_schema_from_fields(monkeypatch):
+    expected_schema = SparkBase._spark_schema(FieldsModel.schema())
+
+    def fail(schema):
+        raise AssertionError("The json schema should not be converted")
+
+    monkeypatch.setattr(FieldsModel, "_spark_schema", staticmethod(fail))
+    assert FieldsModel.spark_schema() == expected_schema
+
+
+class SchemaOverrideModel(SparkBase):
+    c1: int
+
+    @classmethod
+    def schema(cls, *args, **kwargs):
+        schema = super().schema(*args, **kwargs)
+        schema["properties"]["c1"] = {"title": "C1", "type": "string"}
+        return schema
+
+
+def test_schema_override():
+    result = SchemaOverrideModel.spark_schema()
+    assert result == json.loads(
+        StructType(
+            [StructField("c1", StringType(), nullable=False, metadata={"parentClass": "SchemaOverrideModel"})]
+        ).json()
+    )
+
+
+def test_schema_shares_nothing():
+    result = ReusedObjectArray.spark_schema()
+    # Both fields refer to the same definition, mutating one of them must not change the other
+    result["fields"][0]["type"]["elementType"]["fields"].clear()
+    assert len(result["fields"][1]["type"]["fields"]) == 1
+    assert len(ReusedObjectArray.spark_schema()["fields"][0]["type"]["elementType"]["fields"]) == 1
+
+    result = ReusedObjectArray.spark_schema()
+    assert pickle.loads(pickle.dumps(result)) == result
+
+
+def test_definition_cache():
+    pytest.importorskip("orjson")
+
+    class SharedModel(SparkBase):
+        c1: int = 0
+        c2: str = ""
+
+    class SharedParent1(SparkBase):
+        c1: List[SharedModel]
+
+    class SharedParent2(SparkBase):
+        c1: List[SharedModel]
+
+    SharedParent1.spark_schema()
+    cache_size = len(base._DEFINITION_CACHE)
+    # The definition of SharedModel was already converted for the first parent
+    assert SharedParent2.spark_schema()["fields"][0]["type"] == SharedParent1.spark_schema()["fields"][0]["type"]
+    assert len(base._DEFINITION_CACHE) == cache_size
+
+
+def test_definition_cache_field_order():
+    def make_parent(reverse: bool):
+        if reverse:
+
+            class SharedModel(SparkBase):
+                c2: str = ""
+                c1: int = 0
+
+        else:
+
+            class SharedModel(SparkBase):  # type: ignore[no-redef]
+                c1: int = 0
+                c2: str = ""
+
+        class SharedParent(SparkBase):
+            c1: List[SharedModel]
+
+        return SharedParent
+
+    # Same title and fields but a different order must not share a cache entry, spark fields are positional
+    for reverse, expected in ((False, ["c1", "c2"]), (True, ["c2", "c1"])):
+        result = make_parent(reverse).spark_schema()
+        assert [f["name"] for f in result["fields"][0]["type"]["elementType"]["fields"]] == expected